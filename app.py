@@ -3,13 +3,22 @@
 # "New thread" button, larger Ask box, and show only current run responses.
 
 import os
+import hashlib
 import time
-import json
-import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 import requests
 import streamlit as st
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:  # optional; fall back to requests' stdlib json decoding
+    orjson = None
+
 load_dotenv()
 
 def read_setting(key: str, required: bool = True, default: str = "") -> str:
@@ -24,12 +33,27 @@ ORCHESTRATOR_AGENT_ID = read_setting("ORCHESTRATOR_AGENT_ID")
 
 # Auth and SDK clients
 from azure.identity import DefaultAzureCredential
-credential = DefaultAzureCredential(exclude_interactive_browser_credential=False)
-
 from azure.ai.agents import AgentsClient
-from azure.ai.agents.models import CodeInterpreterTool, MessageAttachment
+from azure.ai.agents.models import CodeInterpreterTool, MessageAttachment, ThreadRun
+
+# Built once per process; reruns and new sessions reuse them instead of re-probing credentials
+@st.cache_resource
+def get_credential() -> DefaultAzureCredential:
+    return DefaultAzureCredential(exclude_interactive_browser_credential=False)
+
+@st.cache_resource
+def get_agents_client() -> AgentsClient:
+    return AgentsClient(endpoint=PROJECT_ENDPOINT, credential=get_credential())
+
+@st.cache_resource
+def get_ci_tool_defs() -> list:
+    return CodeInterpreterTool().definitions
 
-agents = AgentsClient(endpoint=PROJECT_ENDPOINT, credential=credential)
+credential = get_credential()
+agents = get_agents_client()
+
+MAX_LOG_ENTRIES = 500
+CI_FILES_TTL = 30  # seconds a per-agent CI file listing is reused before refetching
 
 # Session state
 if "thread_id" not in st.session_state:
@@ -39,23 +63,47 @@ if "file_id" not in st.session_state:
 if "agent_list" not in st.session_state:
     st.session_state["agent_list"] = []
 if "logs" not in st.session_state:
-    st.session_state["logs"] = []
+    st.session_state["logs"] = deque(maxlen=MAX_LOG_ENTRIES)  # bounded so long sessions don't grow without limit
+if "_ci_files_cache" not in st.session_state:
+    st.session_state["_ci_files_cache"] = {}  # agent_id -> (rows, stored_at), also seeded after our own mutations
+if "_uploaded_digests" not in st.session_state:
+    st.session_state["_uploaded_digests"] = {}  # (agent_id, casefolded filename) -> (digest, file_id) of our last upload
 
 def log(msg: str):
     st.session_state["logs"].append(msg)
 
 def get_bearer_token_for_foundry() -> str:
+    # Reuse the session's token until ~60s before it expires
+    cached = st.session_state.get("_aad_token")
+    if cached and time.time() < cached[1] - 60:
+        return cached[0]
     token = credential.get_token("https://ai.azure.com/.default")
+    st.session_state["_aad_token"] = (token.token, token.expires_on)
     return token.token
 
-@st.cache_data(ttl=60)
+# Pooled HTTP session for Foundry REST calls; cached so TLS connections stay warm across reruns
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504))
+    session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=retry))
+    return session
+
+SESSION = get_http_session()
+
+def auth_headers() -> dict:
+    return {"Authorization": f"Bearer {get_bearer_token_for_foundry()}"}
+
+def parse_json(resp: requests.Response):
+    return orjson.loads(resp.content) if orjson else resp.json()
+
+@st.cache_resource(ttl=60)  # not dropped by cache_data clears; refreshed explicitly from the sidebar
 def fetch_agents_list_rest():
     # List Agents (project scoped)
     url = f"{PROJECT_ENDPOINT}/assistants?api-version=v1"
-    headers = {"Authorization": f"Bearer {get_bearer_token_for_foundry()}"}
-    resp = requests.get(url, headers=headers, timeout=60)
+    resp = SESSION.get(url, headers=auth_headers(), timeout=60)
     resp.raise_for_status()
-    data = resp.json().get("data", [])
+    data = parse_json(resp).get("data", [])
     items = []
     for a in data:
         label = (a.get("name") or "").strip() or a.get("id")
@@ -64,52 +112,115 @@ def fetch_agents_list_rest():
         items.insert(0, ("Orchestrator", ORCHESTRATOR_AGENT_ID))
     return items
 
-def get_agent(agent_id: str) -> dict:
+def fetch_agent_rest(agent_id: str) -> dict:
+    # Uncached read; used right before writes so they start from the agent's current state
     url = f"{PROJECT_ENDPOINT}/assistants/{agent_id}?api-version=v1"
-    headers = {"Authorization": f"Bearer {get_bearer_token_for_foundry()}"}
-    resp = requests.get(url, headers=headers, timeout=60)
+    resp = SESSION.get(url, headers=auth_headers(), timeout=60)
     resp.raise_for_status()
-    return resp.json()
+    return parse_json(resp)
+
+@st.cache_data(ttl=5)
+def get_agent(agent_id: str) -> dict:
+    return fetch_agent_rest(agent_id)
 
-def files_get_rest(file_id: str) -> dict:
+def agent_ci_file_ids(agent: dict) -> list:
+    return agent.get("tool_resources", {}).get("code_interpreter", {}).get("file_ids", []) or []
+
+def files_get_rest(file_id: str, headers: Optional[dict] = None) -> dict:
     # Resolve filename/size for display
     url = f"{PROJECT_ENDPOINT}/files/{file_id}?api-version=v1"
-    headers = {"Authorization": f"Bearer {get_bearer_token_for_foundry()}"}
-    resp = requests.get(url, headers=headers, timeout=60)
+    resp = SESSION.get(url, headers=headers or auth_headers(), timeout=60)
     resp.raise_for_status()
-    return resp.json()
+    return parse_json(resp)
+
+def cache_ci_files(agent_id: str, rows: list):
+    st.session_state["_ci_files_cache"][agent_id] = (rows, time.time())
 
 def list_agent_ci_files(agent_id: str):
-    agent = get_agent(agent_id)
-    file_ids = agent.get("tool_resources", {}).get("code_interpreter", {}).get("file_ids", []) or []
-    rows = []
-    for fid in file_ids:
-        try:
-            meta = files_get_rest(fid)
-            rows.append({"file_id": fid, "filename": meta.get("filename", ""), "bytes": meta.get("bytes")})
-        except Exception:
-            rows.append({"file_id": fid, "filename": "(unavailable)", "bytes": None})
+    # Sidebar display only: may be up to CI_FILES_TTL old, so never build writes from it
+    cached = st.session_state["_ci_files_cache"].get(agent_id)
+    if cached is not None and time.time() - cached[1] < CI_FILES_TTL:
+        return cached[0]
+    rows, _ = fetch_agent_ci_files_rest(get_agent(agent_id))
+    cache_ci_files(agent_id, rows)
     return rows
 
-def set_agent_ci_file_ids(agent_id: str, file_ids: list):
-    # Ensure CI tool remains present while updating tool_resources
-    agent = get_agent(agent_id)
+def fetch_agent_ci_files_rest(agent: dict):
     tools = agent.get("tools", []) or []
-    if not any((t.get("type") == "code_interpreter") for t in tools):
+    file_ids = agent_ci_file_ids(agent)
+    if not file_ids:
+        return [], tools
+    # Headers are resolved here: worker threads have no access to st.session_state
+    headers = auth_headers()
+
+    def fetch_row(fid: str) -> dict:
+        try:
+            meta = files_get_rest(fid, headers=headers)
+            return {"file_id": fid, "filename": meta.get("filename", ""), "bytes": meta.get("bytes")}
+        except Exception:
+            return {"file_id": fid, "filename": "(unavailable)", "bytes": None}
+
+    with ThreadPoolExecutor(max_workers=min(8, len(file_ids))) as executor:
+        return list(executor.map(fetch_row, file_ids)), tools
+
+def set_agent_ci_file_ids(agent_id: str, file_ids: list, tools: Optional[list] = None):
+    # Ensure CI tool remains present while updating tool_resources; pass tools only from a
+    # read made in the same user action to skip re-fetching the agent
+    if tools is None:
+        tools = fetch_agent_rest(agent_id).get("tools", []) or []
+    tools = list(tools)
+    tool_types = {t.get("type") for t in tools}
+    if "code_interpreter" not in tool_types:
         tools.append({"type": "code_interpreter"})
     body = {"tools": tools, "tool_resources": {"code_interpreter": {"file_ids": file_ids}}}
     url = f"{PROJECT_ENDPOINT}/assistants/{agent_id}?api-version=v1"
-    headers = {"Authorization": f"Bearer {get_bearer_token_for_foundry()}", "Content-Type": "application/json"}
-    resp = requests.post(url, headers=headers, data=json.dumps(body), timeout=60)
+    resp = SESSION.post(url, headers=auth_headers(), json=body, timeout=60)
     resp.raise_for_status()
-    return resp.json()
+    get_agent.clear()  # later reads must see the updated tool_resources
+    return parse_json(resp)
+
+def run_orchestrator(thread_id: str) -> ThreadRun:
+    # Prefer pushed run events; SDKs without runs.stream fall back to polling
+    if hasattr(agents.runs, "stream"):
+        run = None
+        with agents.runs.stream(thread_id=thread_id, agent_id=ORCHESTRATOR_AGENT_ID) as stream:
+            for _, event_data, _ in stream:
+                if isinstance(event_data, ThreadRun):
+                    run = event_data
+                    if run.status in ("completed", "failed", "cancelled", "expired"):
+                        break
+        if run is None:
+            raise RuntimeError("Run stream ended without reporting a run.")
+        return run
+
+    run = agents.runs.create(thread_id=thread_id, agent_id=ORCHESTRATOR_AGENT_ID)
+    delay = 0.25  # back off from fast polls so short runs return quickly
+    while run.status in ("queued", "in_progress", "requires_action"):
+        time.sleep(delay)
+        delay = min(delay * 1.5, 2.0)
+        run = agents.runs.get(thread_id=thread_id, run_id=run.id)
+    return run
+
+def run_assistant_texts(thread_id: str, run_id: str) -> list:
+    # messages.list has no role filter; run_id already scopes the server query to this run's
+    # output, so a typical 20-item page replaces the old limit=100 fetch
+    chunks = []
+    for m in agents.messages.list(thread_id=thread_id, run_id=run_id, order="asc", limit=20):
+        if m.role != "assistant":
+            continue
+        for tmc in getattr(m, "text_messages", None) or []:
+            if getattr(tmc, "text", None) and getattr(tmc.text, "value", None):
+                chunks.append(tmc.text.value)
+    return chunks
 
 st.title("AI Foundry Orchestrated Multi‑Agent with File upload")
 
 with st.sidebar:
     st.header("Agent & File Controls")
     if st.button("Refresh agent list"):
-        st.cache_data.clear()
+        fetch_agents_list_rest.clear()
+        get_agent.clear()
+        st.session_state["_ci_files_cache"] = {}
     try:
         st.session_state["agent_list"] = fetch_agents_list_rest()
     except Exception as e:
@@ -120,92 +231,108 @@ with st.sidebar:
         st.error("No agents found in this project.")
         st.stop()
 
-    display_names = [n for n, _ in st.session_state["agent_list"]]
-    chosen = st.selectbox("Target agent", display_names, index=0)
-    chosen_agent_id = dict(st.session_state["agent_list"])[chosen]
+    names_to_ids = {n: i for n, i in st.session_state["agent_list"]}
+    chosen = st.selectbox("Target agent", list(names_to_ids.keys()), index=0)
+    chosen_agent_id = names_to_ids[chosen]
 
     # New thread button
     if st.button("New thread"):
         thread = agents.threads.create()
         st.session_state["thread_id"] = thread.id
-        st.session_state["logs"] = []
+        st.session_state["logs"] = deque(maxlen=MAX_LOG_ENTRIES)
         st.success(f"Started a new thread: {thread.id}")
 
-    # Existing CI files with inline Delete
-    st.subheader("Files in Code Interpreter")
-    try:
-        ci_files = list_agent_ci_files(chosen_agent_id)
-        if ci_files:
-            for f in ci_files:
-                c1, c2 = st.columns([0.75, 0.25])
-                with c1:
-                    st.write(f"- {f['filename']} (id={f['file_id']}, bytes={f['bytes']})")
-                with c2:
-                    if st.button("Delete", key=f"del_{f['file_id']}"):
-                        try:
-                            remaining = [x["file_id"] for x in ci_files if x["file_id"] != f["file_id"]]
-                            set_agent_ci_file_ids(chosen_agent_id, remaining)  # remove from tool_resources
-                            try:
-                                agents.files.delete(file_id=f["file_id"])  # remove file object
-                            except Exception:
-                                pass
-                            st.success(f"Deleted {f['filename']} from CI and project.")
-                            st.cache_data.clear(); st.rerun()
-                        except Exception as e:
-                            st.error(f"Delete failed: {e}")
-        else:
-            st.info("No files attached to Code Interpreter for this agent.")
-    except Exception as e:
-        st.warning(f"Could not list CI files: {e}")
+    # Existing CI files with inline Delete; only fetched once the user asks for them
+    with st.expander("Files in Code Interpreter", expanded=False):
+        if st.toggle("Show files", key="show_ci_files"):
+            try:
+                ci_files = list_agent_ci_files(chosen_agent_id)
+                if ci_files:
+                    for f in ci_files:
+                        c1, c2 = st.columns([0.75, 0.25])
+                        with c1:
+                            st.write(f"- {f['filename']} (id={f['file_id']}, bytes={f['bytes']})")
+                        with c2:
+                            if st.button("Delete", key=f"del_{f['file_id']}"):
+                                try:
+                                    agent = fetch_agent_rest(chosen_agent_id)  # fresh state, not the display cache
+                                    agent_tools = agent.get("tools", []) or []
+                                    remaining = [fid for fid in agent_ci_file_ids(agent) if fid != f["file_id"]]
+                                    set_agent_ci_file_ids(chosen_agent_id, remaining, tools=agent_tools)  # remove from tool_resources
+                                    known = {x["file_id"]: x for x in ci_files}
+                                    if all(fid in known for fid in remaining):
+                                        cache_ci_files(chosen_agent_id, [known[fid] for fid in remaining])
+                                    else:  # files were attached elsewhere; let the sidebar refetch them
+                                        st.session_state["_ci_files_cache"].pop(chosen_agent_id, None)
+                                    try:
+                                        agents.files.delete(file_id=f["file_id"])  # remove file object
+                                    except Exception:
+                                        pass
+                                    st.success(f"Deleted {f['filename']} from CI and project.")
+                                    st.rerun()
+                                except Exception as e:
+                                    st.error(f"Delete failed: {e}")
+                else:
+                    st.info("No files attached to Code Interpreter for this agent.")
+            except Exception as e:
+                st.warning(f"Could not list CI files: {e}")
 
 # Upload and overwrite-by-filename (preserve original filename; no temp suffix)
 uploaded = st.file_uploader("Upload a file to attach/persist in Code Interpreter", type=["xlsx","xlsm","xls","csv","pdf","png","jpg","jpeg"])
 
 if uploaded and st.button("Upload and persist (overwrite by filename)"):
-    # Write bytes to a temp directory with the original name, then upload by file_path + filename
-    data = uploaded.getvalue()
-    with st.spinner("Uploading to Foundry Files…"):
-        tmpdir = tempfile.mkdtemp()
-        tmp_path = os.path.join(tmpdir, uploaded.name)  # exact original name; no random suffix
-        with open(tmp_path, "wb") as f:
-            f.write(data)
+    # Skip the upload when these exact bytes are already attached under this name
+    digest = hashlib.blake2b(uploaded.getvalue(), digest_size=16).hexdigest()
+    digest_key = (chosen_agent_id, uploaded.name.casefold())  # same name matching as the overwrite below
+    seen = st.session_state["_uploaded_digests"].get(digest_key)
+    unchanged = seen is not None and seen[0] == digest
+    if unchanged:
         try:
-            # Preserve stored name using filename kw per FilesOperations.upload
-            new_file = agents.files.upload(file_path=tmp_path, purpose="assistants", filename=uploaded.name)  # API supports filename kw
+            unchanged = seen[1] in agent_ci_file_ids(fetch_agent_rest(chosen_agent_id))  # fresh, not the display cache
+        except Exception:
+            unchanged = False
+
+    if unchanged:
+        st.session_state["file_id"] = seen[1]
+        st.info(f"File '{uploaded.name}' is unchanged and already in Code Interpreter; upload skipped.")
+        log(f"Skipped upload of unchanged '{uploaded.name}' (file_id={seen[1]}).")
+    else:
+        # Stream the uploaded buffer straight to Foundry; filename kw preserves the original name
+        with st.spinner("Uploading to Foundry Files…"):
+            new_file = agents.files.upload(file=uploaded, purpose="assistants", filename=uploaded.name)
             st.session_state["file_id"] = new_file.id
             log(f"Uploaded new file_id={new_file.id} for '{uploaded.name}'.")
-        finally:
-            try:
-                os.remove(tmp_path)
-                os.rmdir(tmpdir)
-            except Exception:
-                pass
 
-    # Persist in CI, overwriting by filename if needed
-    try:
-        ci_files = list_agent_ci_files(chosen_agent_id)
-        existing_ids = [e["file_id"] for e in ci_files]
-        existing_by_name = {(e["filename"] or "").lower(): e for e in ci_files}
-        new_name_lc = uploaded.name.lower()
-
-        if new_name_lc in existing_by_name:
-            old_id = existing_by_name[new_name_lc]["file_id"]
-            new_ids = [st.session_state["file_id"] if fid == old_id else fid for fid in existing_ids]
-            set_agent_ci_file_ids(chosen_agent_id, new_ids)
-            try:
-                agents.files.delete(file_id=old_id)
-            except Exception:
-                pass
-            st.success(f"File '{uploaded.name}' has been overwritten in Code Interpreter.")
-            log(f"Overwritten: '{uploaded.name}' old_id={old_id} -> new_id={st.session_state['file_id']}.")
-        else:
-            set_agent_ci_file_ids(chosen_agent_id, existing_ids + [st.session_state["file_id"]])
-            st.success(f"File '{uploaded.name}' attached to Code Interpreter.")
-            log(f"Persisted new file to CI: '{uploaded.name}' id={st.session_state['file_id']}.")
-
-        st.cache_data.clear(); st.rerun()
-    except Exception as e:
-        st.error(f"Persist/overwrite failed: {e}")
+        # Persist in CI, overwriting by filename if needed
+        try:
+            # Build the new id list from fresh state so files attached elsewhere are kept
+            ci_files, agent_tools = fetch_agent_ci_files_rest(fetch_agent_rest(chosen_agent_id))
+            existing_ids = [e["file_id"] for e in ci_files]
+            existing_by_name = {e["filename"].casefold(): e for e in ci_files if e.get("filename")}
+            new_name_lc = uploaded.name.casefold()
+            new_row = {"file_id": st.session_state["file_id"], "filename": uploaded.name, "bytes": uploaded.size}
+
+            if new_name_lc in existing_by_name:
+                old_id = existing_by_name[new_name_lc]["file_id"]
+                new_ids = [st.session_state["file_id"] if fid == old_id else fid for fid in existing_ids]
+                set_agent_ci_file_ids(chosen_agent_id, new_ids, tools=agent_tools)
+                cache_ci_files(chosen_agent_id, [new_row if e["file_id"] == old_id else e for e in ci_files])
+                try:
+                    agents.files.delete(file_id=old_id)
+                except Exception:
+                    pass
+                st.success(f"File '{uploaded.name}' has been overwritten in Code Interpreter.")
+                log(f"Overwritten: '{uploaded.name}' old_id={old_id} -> new_id={st.session_state['file_id']}.")
+            else:
+                set_agent_ci_file_ids(chosen_agent_id, existing_ids + [st.session_state["file_id"]], tools=agent_tools)
+                cache_ci_files(chosen_agent_id, ci_files + [new_row])
+                st.success(f"File '{uploaded.name}' attached to Code Interpreter.")
+                log(f"Persisted new file to CI: '{uploaded.name}' id={st.session_state['file_id']}.")
+
+            st.session_state["_uploaded_digests"][digest_key] = (digest, st.session_state["file_id"])
+            st.rerun()
+        except Exception as e:
+            st.error(f"Persist/overwrite failed: {e}")
 
 # Larger Ask box
 question = st.text_area("Ask the orchestrator", height=180, placeholder="Type a detailed question or instructions...")
@@ -224,35 +351,20 @@ if st.button("Run"):
     # Attach last uploaded file so CI can read it this run
     attachments = []
     if st.session_state.get("file_id"):
-        ci_tool = CodeInterpreterTool()
-        attachments = [MessageAttachment(file_id=st.session_state["file_id"], tools=ci_tool.definitions)]
+        attachments = [MessageAttachment(file_id=st.session_state["file_id"], tools=get_ci_tool_defs())]
         log("File attached to Code Interpreter for this run (message-level).")
 
     user_prompt = question or "Please analyze the uploaded file."
     agents.messages.create(thread_id=thread.id, role="user", content=user_prompt, attachments=attachments)
 
     with st.spinner("Running orchestrator…"):
-        run = agents.runs.create(thread_id=thread.id, agent_id=ORCHESTRATOR_AGENT_ID)
-        status = run.status
-        while status in ("queued", "in_progress", "requires_action"):
-            time.sleep(2)
-            run = agents.runs.get(thread_id=thread.id, run_id=run.id)
-            status = run.status
-        st.info(f"Run status: {status}")
+        run = run_orchestrator(thread.id)
+        st.info(f"Run status: {run.status}")
 
     # Show only current run’s assistant messages
-    pager = agents.messages.list(thread_id=thread.id, run_id=run.id, order="asc", limit=100)
-    chunks = []
-    for m in pager:
-        if m.role != "assistant":
-            continue
-        if getattr(m, "text_messages", None):
-            for tmc in m.text_messages:
-                if getattr(tmc, "text", None) and getattr(tmc.text, "value", None):
-                    chunks.append(tmc.text.value)
+    chunks = run_assistant_texts(thread.id, run.id)
     if chunks:
-        st.markdown("**Assistant:**")
-        st.write("\n\n".join(chunks))
+        st.markdown("**Assistant:**\n\n" + "\n\n".join(chunks))
     else:
         st.warning("No assistant response generated.")
 